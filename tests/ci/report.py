@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import io
 import os
 import datetime
 
@@ -128,28 +129,51 @@ def _get_html_url(url):
     return ''
 
 
-def create_test_html_report(header, test_result, raw_log_url, task_url, branch_url, branch_name, commit_url, additional_urls=None, with_raw_logs=False):
+def create_test_html_report(header, test_result, raw_log_url, task_url, branch_url, branch_name, commit_url, additional_urls=None, with_raw_logs=False, out=None):
     if additional_urls is None:
         additional_urls = []
 
+    additional_html_urls = ""
+    for url in additional_urls:
+        additional_html_urls += ' ' + _get_html_url(url)
+
+    # When out is given the report is streamed into it section by section
+    # instead of materializing one giant string.
+    buf = io.StringIO() if out is None else out
+
+    base_head, base_tail = HTML_BASE_TEST_TEMPLATE.split('{test_part}')
+    buf.write(base_head.format(
+        title=_format_header(header, branch_name),
+        header=_format_header(header, branch_name, branch_url),
+        raw_log_name=os.path.basename(raw_log_url),
+        raw_log_url=raw_log_url,
+        task_url=task_url,
+        branch_name=branch_name,
+        commit_url=commit_url,
+        additional_urls=additional_html_urls
+    ))
+
     if test_result:
-        rows_part = ""
+        has_test_time = any(len(result) > 2 for result in test_result)
+        has_test_logs = any(len(result) > 3 for result in test_result)
+
+        headers = list(BASE_HEADERS)
+        if has_test_time:
+            headers.append('Test time, sec.')
+        if has_test_logs and not with_raw_logs:
+            headers.append('Logs')
+
+        buf.write("\n<table>\n<tr>\n")
+        buf.write(''.join(['<th>' + h + '</th>' for h in headers]))
+        buf.write("\n</tr>\n")
+
         num_fails = 0
-        has_test_time = False
-        has_test_logs = False
         for result in test_result:
             test_name = result[0]
             test_status = result[1]
 
-            test_logs = None
-            test_time = None
-            if len(result) > 2:
-                test_time = result[2]
-                has_test_time = True
-
-            if len(result) > 3:
-                test_logs = result[3]
-                has_test_logs = True
+            test_time = result[2] if len(result) > 2 else None
+            test_logs = result[3] if len(result) > 3 else None
 
             row = "<tr>"
             is_fail = test_status in ('FAIL', 'FLAKY')
@@ -174,41 +198,21 @@ def create_test_html_report(header, test_result, raw_log_url, task_url, branch_u
                 row += "<td>" + test_logs_html + "</td>"
 
             row += "</tr>"
-            rows_part += row
+            buf.write(row)
             if test_logs is not None and with_raw_logs:
                 row = "<tr class=\"failed-content\">"
                 # TODO: compute colspan too
                 row += "<td colspan=\"3\"><pre>" + test_logs + "</pre></td>"
                 row += "</tr>"
-                rows_part += row
-
-        headers = BASE_HEADERS
-        if has_test_time:
-            headers.append('Test time, sec.')
-        if has_test_logs and not with_raw_logs:
-            headers.append('Logs')
+                buf.write(row)
 
-        headers = ''.join(['<th>' + h + '</th>' for h in headers])
-        test_part = HTML_TEST_PART.format(headers=headers, rows=rows_part)
-    else:
-        test_part = ""
+        buf.write("\n</table>\n")
 
-    additional_html_urls = ""
-    for url in additional_urls:
-        additional_html_urls += ' ' + _get_html_url(url)
+    buf.write(base_tail.format())
 
-    result = HTML_BASE_TEST_TEMPLATE.format(
-        title=_format_header(header, branch_name),
-        header=_format_header(header, branch_name, branch_url),
-        raw_log_name=os.path.basename(raw_log_url),
-        raw_log_url=raw_log_url,
-        task_url=task_url,
-        test_part=test_part,
-        branch_name=branch_name,
-        commit_url=commit_url,
-        additional_urls=additional_html_urls
-    )
-    return result
+    if out is None:
+        return buf.getvalue()
+    return None
 
 
 HTML_BASE_BUILD_TEMPLATE = """
@@ -4,6 +4,7 @@ import logging
 import os
 from multiprocessing.dummy import Pool
 import boto3
+from botocore.config import Config
 from compress_files import compress_file_fast
 
 def _md5(fname):
@@ -28,7 +29,8 @@ def _flatten_list(lst):
 class S3Helper():
     def __init__(self, host):
         self.session = boto3.session.Session(region_name='us-east-1')
-        self.client = self.session.client('s3', endpoint_url=host)
+        # enough connections for parallel uploads from thread pools
+        self.client = self.session.client('s3', endpoint_url=host, config=Config(max_pool_connections=16))
 
     def _upload_file_to_s3(self, bucket_name, file_path, s3_path):
         logging.debug("Start uploading %s to bucket=%s path=%s", file_path, bucket_name, s3_path)
@@ -1,67 +1,113 @@
 #!/usr/bin/env python3
 
 import logging
+import mmap
 import os
+import random
+import re
+import shutil
 import sys
 import time
 import subprocess
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 from github import Github
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from report import create_test_html_report
 from s3_helper import S3Helper
 from get_robot_token import get_best_robot_token
 from pr_info import PRInfo
 
+try:
+    import orjson
+
+    def load_json(path):
+        with open(path, 'rb') as json_file:
+            return orjson.loads(json_file.read())
+except ImportError:
+    def load_json(path):
+        with open(path, 'r', encoding='utf-8') as json_file:
+            return json.load(json_file)
+
 IMAGE_NAME = 'clickhouse/unit-test'
 
+RUN_ID = os.getenv("GITHUB_RUN_ID", "")
+REPO = os.getenv("GITHUB_REPOSITORY", "ClickHouse/ClickHouse")
+
+# characters not allowed in the s3 path prefix, replaced in one pass
+S3_PATH_SANITIZE = str.maketrans(' (),', '____')
+
 DOWNLOAD_RETRIES_COUNT = 5
 
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=DOWNLOAD_RETRIES_COUNT,
+        backoff_factor=1.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True)))
+
 def process_logs(s3_client, additional_logs, s3_path_prefix):
-    additional_urls = []
-    for log_path in additional_logs:
-        if log_path:
-            additional_urls.append(
-                s3_client.upload_test_report_to_s3(
-                    log_path,
-                    s3_path_prefix + "/" + os.path.basename(log_path)))
+    def upload_log(log_path):
+        return s3_client.upload_test_report_to_s3(
+            log_path,
+            s3_path_prefix + "/" + os.path.basename(log_path))
 
-    return additional_urls
+    # uploads are independent and I/O bound, boto3 clients are thread-safe
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(upload_log, [log_path for log_path in additional_logs if log_path]))
 
 def dowload_build_with_progress(url, path):
     logging.info("Downloading from %s to temp path %s", url, path)
+    # download to a temp name on the same filesystem and rename on success, so
+    # a failed attempt never leaves a corrupt binary at the final path
+    tmp_path = path + ".part"
+    # the session Retry only covers the connect/status phase of each attempt;
+    # errors while reading the streamed body surface here and restart the download
     for i in range(DOWNLOAD_RETRIES_COUNT):
         try:
-            with open(path, 'wb') as f:
-                response = requests.get(url, stream=True)
+            with open(tmp_path, 'wb', buffering=1024 * 1024) as f:
+                response = SESSION.get(url, stream=True, timeout=(10, 120))
                 response.raise_for_status()
                 total_length = response.headers.get('content-length')
                 if total_length is None or int(total_length) == 0:
                     logging.info("No content-length, will download file without progress")
                     f.write(response.content)
+                elif not sys.stdout.isatty():
+                    logging.info("Content length is %ld bytes, no tty, downloading without progress", int(total_length))
+                    # binary artifact, never served compressed: skip the per-chunk decode check
+                    response.raw.decode_content = False
+                    shutil.copyfileobj(response.raw, f, length=1024 * 1024)
                 else:
                     dl = 0
                     total_length = int(total_length)
                     logging.info("Content length is %ld bytes", total_length)
-                    for data in response.iter_content(chunk_size=4096):
+                    last_percent = -1
+                    for data in response.iter_content(chunk_size=1024 * 1024):
                         dl += len(data)
                         f.write(data)
-                        if sys.stdout.isatty():
+                        percent = int(100 * dl / total_length)
+                        if percent != last_percent:
+                            last_percent = percent
                             done = int(50 * dl / total_length)
-                            percent = int(100 * float(dl) / total_length)
                             eq_str = '=' * done
                             space_str = ' ' * (50 - done)
                             sys.stdout.write(f"\r[{eq_str}{space_str}] {percent}%")
                             sys.stdout.flush()
+            os.replace(tmp_path, path)
             break
         except Exception as ex:
             sys.stdout.write("\n")
-            time.sleep(3)
             logging.info("Exception while downloading %s, retry %s", ex, i + 1)
-            if os.path.exists(path):
-                os.remove(path)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            time.sleep(min(30, 2 ** i) + random.random())
     else:
         raise Exception(f"Cannot download dataset from {url}, all retries exceeded")
 
@@ -70,8 +116,8 @@ def dowload_build_with_progress(url, path):
 
 
 def upload_results(s3_client, pr_number, commit_sha, test_results, raw_log, additional_files, check_name):
-    additional_files = [raw_log] + additional_files
-    s3_path_prefix = f"{pr_number}/{commit_sha}/" + check_name.lower().replace(' ', '_').replace('(', '_').replace(')', '_').replace(',', '_')
+    s3_path_prefix = f"{pr_number}/{commit_sha}/" + check_name.lower().translate(S3_PATH_SANITIZE)
+    raw_log_url = s3_client.upload_test_report_to_s3(raw_log, s3_path_prefix + "/" + os.path.basename(raw_log))
     additional_urls = process_logs(s3_client, additional_files, s3_path_prefix)
 
     branch_url = "https://github.com/ClickHouse/ClickHouse/commits/master"
@@ -81,69 +127,66 @@ def upload_results(s3_client, pr_number, commit_sha, test_results, raw_log, addi
         branch_url = f"https://github.com/ClickHouse/ClickHouse/pull/{pr_number}"
     commit_url = f"https://github.com/ClickHouse/ClickHouse/commit/{commit_sha}"
 
-    task_url = f"https://github.com/ClickHouse/ClickHouse/actions/runs/{os.getenv('GITHUB_RUN_ID')}"
-
-    raw_log_url = additional_urls[0]
-    additional_urls.pop(0)
+    task_url = f"https://github.com/ClickHouse/ClickHouse/actions/runs/{RUN_ID}"
 
-    html_report = create_test_html_report(check_name, test_results, raw_log_url, task_url, branch_url, branch_name, commit_url, additional_urls, True)
-    with open('report.html', 'w', encoding='utf-8') as f:
-        f.write(html_report)
+    with open('report.html', 'w', encoding='utf-8', buffering=1024 * 1024) as f:
+        create_test_html_report(check_name, test_results, raw_log_url, task_url, branch_url, branch_name, commit_url, additional_urls, True, out=f)
 
     url = s3_client.upload_test_report_to_s3('report.html', s3_path_prefix + ".html")
     logging.info("Search result in url %s", url)
     return url
 
 def get_commit(gh, commit_sha):
-    repo = gh.get_repo(os.getenv("GITHUB_REPOSITORY", "ClickHouse/ClickHouse"))
+    repo = gh.get_repo(REPO)
     commit = repo.get_commit(commit_sha)
     return commit
 
 def get_build_config(build_number, repo_path):
     ci_config_path = os.path.join(repo_path, "tests/ci/ci_config.json")
-    with open(ci_config_path, 'r', encoding='utf-8') as ci_config:
-        config_dict = json.load(ci_config)
-        return config_dict['build_config'][build_number]
+    config_dict = load_json(ci_config_path)
+    return config_dict['build_config'][build_number]
+
+def find_changed_images(reports_path):
+    # stop the walk on the first match instead of reading the rest of the tree
+    for root, _, files in os.walk(reports_path):
+        if 'changed_images.json' in files:
+            return os.path.join(root, 'changed_images.json')
+    return None
 
 def get_build_urls(build_config_str, reports_path):
+    # download-artifact puts every artifact into its own subdirectory,
+    # so the build report has to be looked up recursively
     for root, _, files in os.walk(reports_path):
         for f in files:
-            if build_config_str in f :
+            if build_config_str in f:
                 logging.info("Found build report json %s", f)
-                with open(os.path.join(root, f), 'r', encoding='utf-8') as file_handler:
-                    build_report = json.load(file_handler)
-                    return build_report['build_urls']
+                build_report = load_json(os.path.join(root, f))
+                return build_report['build_urls']
     return []
 
 def build_config_to_string(build_config):
     if build_config["package-type"] == "performance":
         return "performance"
 
-    return "_".join([
-        build_config['compiler'],
-        build_config['build-type'] if build_config['build-type'] else "relwithdebuginfo",
-        build_config['sanitizer'] if build_config['sanitizer'] else "none",
-        build_config['bundled'],
-        build_config['splitted'],
-        "tidy" if build_config['tidy'] == "enable" else "notidy",
-        "with_coverage" if build_config['with_coverage'] else "without_coverage",
-        build_config['package-type'],
-    ])
-
-def get_test_name(line):
-    elements = reversed(line.split(' '))
-    for element in elements:
-        if '(' not in element and ')' not in element:
-            return element
-    raise Exception(f"No test name in line '{line}'")
+    return (
+        f"{build_config['compiler']}"
+        f"_{build_config['build-type'] or 'relwithdebuginfo'}"
+        f"_{build_config['sanitizer'] or 'none'}"
+        f"_{build_config['bundled']}"
+        f"_{build_config['splitted']}"
+        f"_{'tidy' if build_config['tidy'] == 'enable' else 'notidy'}"
+        f"_{'with_coverage' if build_config['with_coverage'] else 'without_coverage'}"
+        f"_{build_config['package-type']}")
+
+# single C-level sweep over the whole log instead of a Python loop with five
+# substring probes per line; test names are captured without decoding the log
+RESULT_MARKERS = re.compile(
+    rb'\[\s+(OK|FAILED)\s+\]\s+(\S+)([^\n]*)'
+    rb'|(Segmentation fault)'
+    rb'|(received signal SIG)'
+    rb'|(PASSED)')
 
 def process_result(result_folder):
-    OK_SIGN = 'OK ]'
-    FAILED_SIGN = 'FAILED  ]'
-    SEGFAULT = 'Segmentation fault'
-    SIGNAL = 'received signal SIG'
-    PASSED = 'PASSED'
-
     summary = []
     total_counter = 0
     failed_counter = 0
@@ -155,34 +198,37 @@ def process_result(result_folder):
     status = "success"
     description = ""
     passed = False
-    with open(result_log_path, 'r', encoding='utf-8') as test_result:
-        for line in test_result:
-            if OK_SIGN in line:
-                logging.info("Found ok line: '%s'", line)
-                test_name = get_test_name(line.strip())
-                logging.info("Test name: '%s'", test_name)
-                summary.append((test_name, "OK"))
-                total_counter += 1
-            elif FAILED_SIGN in line and 'listed below' not in line and 'ms)' in line:
-                logging.info("Found fail line: '%s'", line)
-                test_name = get_test_name(line.strip())
-                logging.info("Test name: '%s'", test_name)
-                summary.append((test_name, "FAIL"))
-                total_counter += 1
-                failed_counter += 1
-            elif SEGFAULT in line:
-                logging.info("Found segfault line: '%s'", line)
-                status = "failure"
-                description += "Segmentation fault. "
-                break
-            elif SIGNAL in line:
-                logging.info("Received signal line: '%s'", line)
-                status = "failure"
-                description += "Exit on signal. "
-                break
-            elif PASSED in line:
-                logging.info("PASSED record found: '%s'", line)
-                passed = True
+    with open(result_log_path, 'rb') as result_file:
+        if os.path.getsize(result_log_path) > 0:
+            with mmap.mmap(result_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_log:
+                for match in RESULT_MARKERS.finditer(mapped_log):
+                    if match.group(1) == b'OK':
+                        test_name = match.group(2).decode('utf-8', 'replace')
+                        logging.debug("Test name: '%s'", test_name)
+                        summary.append((test_name, "OK"))
+                        total_counter += 1
+                    elif match.group(1) == b'FAILED':
+                        line_tail = match.group(3)
+                        if b'listed below' in line_tail or b'ms)' not in line_tail:
+                            continue
+                        test_name = match.group(2).decode('utf-8', 'replace')
+                        logging.debug("Test name: '%s'", test_name)
+                        summary.append((test_name, "FAIL"))
+                        total_counter += 1
+                        failed_counter += 1
+                    elif match.group(4) is not None:
+                        logging.info("Found segfault line: '%s'", match.group(0))
+                        status = "failure"
+                        description += "Segmentation fault. "
+                        break
+                    elif match.group(5) is not None:
+                        logging.info("Received signal line: '%s'", match.group(0))
+                        status = "failure"
+                        description += "Exit on signal. "
+                        break
+                    else:
+                        logging.info("PASSED record found: '%s'", match.group(0))
+                        passed = True
 
     if not passed:
         status = "failure"
@@ -209,37 +255,33 @@ if __name__ == "__main__":
     if not os.path.exists(temp_path):
         os.makedirs(temp_path)
 
-    with open(os.getenv('GITHUB_EVENT_PATH'), 'r', encoding='utf-8') as event_file:
-        event = json.load(event_file)
+    event = load_json(os.getenv('GITHUB_EVENT_PATH'))
 
     pr_info = PRInfo(event)
 
     gh = Github(get_best_robot_token())
 
-    for root, _, files in os.walk(reports_path):
-        for f in files:
-            if f == 'changed_images.json':
-                images_path = os.path.join(root, 'changed_images.json')
-                break
+    images_path = find_changed_images(reports_path)
+
+    docker_bin = shutil.which('docker') or 'docker'
 
     docker_image = IMAGE_NAME
-    if images_path and os.path.exists(images_path):
+    if images_path is not None:
         logging.info("Images file exists")
-        with open(images_path, 'r', encoding='utf-8') as images_fd:
-            images = json.load(images_fd)
-            logging.info("Got images %s", images)
-            if IMAGE_NAME in images:
-                docker_image += ':' + images[IMAGE_NAME]
+        images = load_json(images_path)
+        logging.info("Got images %s", images)
+        if IMAGE_NAME in images:
+            docker_image += ':' + images[IMAGE_NAME]
     else:
         logging.info("Images file not found")
 
     for i in range(10):
         try:
             logging.info("Pulling image %s", docker_image)
-            subprocess.check_output(f"docker pull {docker_image}", stderr=subprocess.STDOUT, shell=True)
+            subprocess.run([docker_bin, "pull", docker_image], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
             break
         except Exception as ex:
-            time.sleep(i * 3)
+            time.sleep(min(30, 2 ** i) + random.random())
             logging.info("Got execption pulling docker %s", ex)
     else:
         raise Exception(f"Cannot pull dockerhub for image docker pull {docker_image}")
@@ -263,22 +305,27 @@ if __name__ == "__main__":
     if not os.path.exists(test_output):
         os.makedirs(test_output)
 
-    run_command = f"docker run --cap-add=SYS_PTRACE --volume={tests_binary_path}:/unit_tests_dbms --volume={test_output}:/test_output {docker_image}"
+    # run as the current user so the output files do not need a recursive chown
+    run_command = [
+        docker_bin, "run", "--cap-add=SYS_PTRACE",
+        f"--user={os.getuid()}:{os.getgid()}",
+        f"--volume={tests_binary_path}:/unit_tests_dbms",
+        f"--volume={test_output}:/test_output",
+        docker_image,
+    ]
 
     run_log_path = os.path.join(test_output, "runlog.log")
 
-    logging.info("Going to run func tests: %s", run_command)
+    logging.info("Going to run func tests: %s", ' '.join(run_command))
 
     with open(run_log_path, 'w', encoding='utf-8') as log:
-        with subprocess.Popen(run_command, shell=True, stderr=log, stdout=log) as process:
+        with subprocess.Popen(run_command, stderr=log, stdout=log) as process:
             retcode = process.wait()
             if retcode == 0:
                 logging.info("Run successfully")
             else:
                 logging.info("Run failed")
 
-    subprocess.check_call(f"sudo chown -R ubuntu:ubuntu {temp_path}", shell=True)
-
     s3_helper = S3Helper('https://s3.amazonaws.com')
     state, description, test_results, additional_logs = process_result(test_output)
     report_url = upload_results(s3_helper, pr_info.number, pr_info.sha, test_results, run_log_path, additional_logs, check_name)